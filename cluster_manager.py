@@ -3,11 +3,13 @@ A module that controls the creation and shutdown of EMR clusters
 """
 import os
 import re
+import threading
 from gzip import decompress
 from time import sleep
 from typing import Callable
 from multiprocessing import Process, Pipe
 import boto3
+from instrumentation import CallRecord, instrument
 
 
 class ClusterManager:
@@ -15,12 +17,25 @@ class ClusterManager:
     Methods for launching/terminating EMR clusters
     """
 
-    def __init__(self, log_uri: str = None, name: str = None):
-        """ Constructor for a ClusterManager instance"""
+    def __init__(
+        self,
+        log_uri: str = None,
+        name: str = None,
+        sink: Callable[[CallRecord], None] = None,
+    ):
+        """
+        Constructor for a ClusterManager instance. If a metrics sink is provided, every EMR
+        and S3 call made by the manager is reported to it (see instrumentation). Calls made
+        by the watch_step poll and callback processes are sent back and reported from this
+        process.
+        """
         self.log_uri = log_uri
         self._tx_poll, self._rx_poll = Pipe()
         self._poll_time = 60
+        self._sink = sink
         self._client = boto3.client("emr", region_name="us-east-1")
+        if sink is not None:
+            instrument(self._client, self._report)
         self.instance_config = {
             "InstanceGroups": [
                 {
@@ -205,8 +220,40 @@ class ClusterManager:
         self._client.terminate_job_flows(JobFlowIds=[cluster_id])
         print("-> Sent termination command for cluster: {}".format(cluster_id))
 
-    def _poll(self, step_id: str, cluster_id: str):
+    def _report(self, record: CallRecord):
+        """ Passes a call record to the current metrics sink """
+        self._sink(record)
+
+    def _metrics_pipe(self):
+        """
+        Returns a (receiver, sender) pipe through which a child process sends call records
+        back to this process, or (None, None) when no metrics sink is set
+        """
+        if self._sink is None:
+            return None, None
+        return Pipe(duplex=False)
+
+    def _forward_metrics(self, rx_metrics):
+        """ Reports call records sent by a child process until it closes the pipe """
+        try:
+            while True:
+                self._report(rx_metrics.recv())
+        except EOFError:
+            rx_metrics.close()
+
+    def _start_forwarding(self, *rx_metrics):
+        """ Starts a thread per pipe that reports call records from a child process """
+        for rx in rx_metrics:
+            if rx is not None:
+                threading.Thread(
+                    target=self._forward_metrics, args=(rx,), daemon=True
+                ).start()
+
+    def _poll(self, step_id: str, cluster_id: str, tx_metrics=None):
         """ Polls the client for the current step state"""
+        if tx_metrics is not None:
+            # The sink lives in the parent process, so send call records back to it
+            self._sink = tx_metrics.send
         shutdown_states = ["COMPLETED", "CANCELLED", "FAILED", "INTERRUPTED"]
         while self.step_status(step_id, cluster_id)[0]["state"] not in shutdown_states:
             self._tx_poll.send(self.step_status(step_id, cluster_id)[0]["state"])
@@ -217,9 +264,19 @@ class ClusterManager:
             )
         )
         self._tx_poll.close()
+        if tx_metrics is not None:
+            tx_metrics.close()
 
-    def _listener(self, callback: Callable[[], None] = None, callback_arg: str = None):
+    def _listener(
+        self,
+        callback: Callable[[], None] = None,
+        callback_arg: str = None,
+        tx_metrics=None,
+    ):
         """ Listens for poll updates """
+        if tx_metrics is not None:
+            # The sink lives in the parent process, so send call records back to it
+            self._sink = tx_metrics.send
         while self._rx_poll.recv() != callback_arg:
             print(
                 "-> Step in state {}, waiting for {}".format(
@@ -227,6 +284,8 @@ class ClusterManager:
                 )
             )
         callback()
+        if tx_metrics is not None:
+            tx_metrics.close()
 
     def report_step(self, step_id: str, cluster_id: str) -> str:
         """
@@ -251,8 +310,11 @@ class ClusterManager:
         When the step is in one of a known set of shutdown states, the poll thread
         is shutdown.
         """
-        proc = Process(target=self._poll, args=(step_id, cluster_id))
+        rx_poll_metrics, tx_poll_metrics = self._metrics_pipe()
+        proc = Process(target=self._poll, args=(step_id, cluster_id, tx_poll_metrics))
         proc.start()
+        if tx_poll_metrics is not None:
+            tx_poll_metrics.close()
         print(
             "-> Watching step {}, will execute your callback when state is {}".format(
                 step_id, callback_arg
@@ -273,9 +335,17 @@ class ClusterManager:
             ]
             if callback_arg not in valid_states:
                 print("-> Callback argument must be one of {}".format(valid_states))
+                self._start_forwarding(rx_poll_metrics)
                 return
-        listener = Process(target=self._listener, args=(callback, callback_arg))
+        rx_listener_metrics, tx_listener_metrics = self._metrics_pipe()
+        listener = Process(
+            target=self._listener, args=(callback, callback_arg, tx_listener_metrics)
+        )
         listener.start()
+        if tx_listener_metrics is not None:
+            tx_listener_metrics.close()
+        # Forwarding threads start only after every fork, so no child inherits their locks
+        self._start_forwarding(rx_poll_metrics, rx_listener_metrics)
 
     def step_status(self, step_id: str, cluster_id: str) -> (dict, str):
         """
@@ -309,6 +379,8 @@ class ClusterManager:
             if not logfile_key.endswith("stderr.gz"):
                 logfile_key += "stderr.gz"
             s3_client = boto3.client("s3")
+            if self._sink is not None:
+                instrument(s3_client, self._report)
 
             try:
                 data = s3_client.get_object(Bucket=logfile_bucket, Key=logfile_key)[
@@ -0,0 +1,342 @@
+"""
+Per-call instrumentation for boto3 clients, built on botocore event hooks.
+
+Every API call made through an instrumented client produces a single CallRecord, which is
+handed to a sink. A sink is any callable that accepts a CallRecord: a plain callback, the
+in-memory MetricsRegistry, or a StatsdSink that emits StatsD-style lines.
+"""
+import functools
+import io
+import socket
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable, Dict, NamedTuple, Tuple
+from urllib.parse import urlencode
+from logger import logging as log
+
+# Upper bounds (in seconds) of the latency histogram buckets. The final bucket is unbounded.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+THROTTLE_CODES = frozenset(
+    [
+        "Throttling",
+        "ThrottlingException",
+        "ThrottledException",
+        "RequestThrottledException",
+        "TooManyRequestsException",
+        "ProvisionedThroughputExceededException",
+        "RequestLimitExceeded",
+        "BandwidthLimitExceeded",
+        "LimitExceededException",
+        "RequestThrottled",
+        "SlowDown",
+        "EC2ThrottledException",
+    ]
+)
+
+
+class CallRecord(NamedTuple):
+    """ Metrics for a single AWS API call, including all of its retry attempts """
+
+    service: str
+    operation: str
+    latency: float
+    bytes_in: int
+    bytes_out: int
+    retries: int
+    throttles: int
+    error: str = None
+
+
+class MetricsRegistry:
+    """
+    In-memory sink that aggregates call records per (service, operation), keeping a latency
+    histogram alongside byte, retry, throttle and error counters
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def __call__(self, record: CallRecord):
+        key = (record.service, record.operation)
+        bucket = bisect_left(self.buckets, record.latency)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {
+                    "calls": 0,
+                    "errors": 0,
+                    "latency_total": 0.0,
+                    "latency_max": 0.0,
+                    "histogram": [0] * (len(self.buckets) + 1),
+                    "bytes_in": 0,
+                    "bytes_out": 0,
+                    "retries": 0,
+                    "throttles": 0,
+                }
+            stats["calls"] += 1
+            stats["latency_total"] += record.latency
+            if record.latency > stats["latency_max"]:
+                stats["latency_max"] = record.latency
+            stats["histogram"][bucket] += 1
+            stats["bytes_in"] += record.bytes_in
+            stats["bytes_out"] += record.bytes_out
+            stats["retries"] += record.retries
+            stats["throttles"] += record.throttles
+            if record.error is not None:
+                stats["errors"] += 1
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Returns a copy of the aggregated metrics, keyed by "service.operation". Each histogram
+        is a list of counts aligned with `buckets`, plus a trailing overflow bucket.
+        """
+        with self._lock:
+            return {
+                "{}.{}".format(service, operation): dict(
+                    stats, histogram=list(stats["histogram"])
+                )
+                for (service, operation), stats in self._stats.items()
+            }
+
+    def reset(self):
+        """ Discards all aggregated metrics """
+        with self._lock:
+            self._stats = {}
+
+
+class StatsdSink:
+    """
+    Sink that formats each call record as StatsD lines and sends them in a single UDP
+    datagram. A `writer` callable may be given instead, receiving the newline-joined lines.
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 8125,
+        prefix: str = "aws",
+        writer: Callable[[str], None] = None,
+    ):
+        self.prefix = prefix
+        self._socket = None
+        self._writer = writer
+        if writer is None:
+            # Resolve the host once rather than per datagram. The socket stays unconnected
+            # so a missing daemon does not surface as ECONNREFUSED on later sends.
+            family, _, _, _, address = socket.getaddrinfo(
+                host, port, type=socket.SOCK_DGRAM
+            )[0]
+            self._address = address
+            self._socket = socket.socket(family, socket.SOCK_DGRAM)
+            self._writer = self._send
+
+    def _send(self, payload: str):
+        """ Sends the payload to the StatsD daemon; like StatsD itself, drops it on failure """
+        try:
+            self._socket.sendto(payload.encode("utf-8"), self._address)
+        except OSError:
+            pass
+
+    def format(self, record: CallRecord) -> str:
+        """ Returns the StatsD lines for the given call record """
+        name = "{}.{}.{}".format(self.prefix, record.service, record.operation)
+        lines = [
+            "{}.latency:{:.3f}|ms".format(name, record.latency * 1000),
+            "{}.calls:1|c".format(name),
+            "{}.bytes_in:{}|c".format(name, record.bytes_in),
+            "{}.bytes_out:{}|c".format(name, record.bytes_out),
+        ]
+        if record.retries:
+            lines.append("{}.retries:{}|c".format(name, record.retries))
+        if record.throttles:
+            lines.append("{}.throttles:{}|c".format(name, record.throttles))
+        if record.error is not None:
+            lines.append("{}.errors:1|c".format(name))
+        return "\n".join(lines)
+
+    def __call__(self, record: CallRecord):
+        self._writer(self.format(record))
+
+    def close(self):
+        """ Closes the UDP socket, if one was opened """
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+def _guarded(handler):
+    """ Wraps an event handler so that a metrics bug is logged instead of failing the request """
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        try:
+            handler(*args, **kwargs)
+        except Exception as err:  # pylint: disable=broad-except
+            log.error("Metrics hook %s failed: %s", handler.__name__, err)
+
+    return wrapper
+
+
+class _Instrumenter:
+    """
+    botocore event handlers that build a CallRecord for every API call made by one client,
+    and fan it out to the client's sinks
+    """
+
+    key = "py_aws_util.metrics"
+
+    def __init__(self):
+        self.sinks = []
+
+    @_guarded
+    def before_call(self, model, context, **kwargs):
+        """ Starts the clock; runs once per API call, before any attempts are made """
+        context[self.key] = {
+            "service": model.service_model.service_name,
+            "operation": model.name,
+            "start": perf_counter(),
+            "bytes_out": 0,
+            "attempts": 1,
+            "throttles": 0,
+        }
+
+    @_guarded
+    def request_created(self, request, **kwargs):
+        """ Counts request body bytes; runs once per attempt """
+        state = (getattr(request, "context", None) or {}).get(self.key)
+        if state is not None:
+            state["bytes_out"] += _request_size(request)
+
+    @_guarded
+    def needs_retry(self, attempts, response=None, request_dict=None, **kwargs):
+        """ Tracks attempts and throttled responses; runs after every attempt """
+        state = ((request_dict or {}).get("context") or {}).get(self.key)
+        if state is None:
+            return
+        state["attempts"] = attempts
+        if response is not None and _is_throttle(response):
+            state["throttles"] += 1
+
+    @_guarded
+    def after_call(self, http_response, parsed, model, context, **kwargs):
+        """ Emits the record for a call which received a response """
+        error = None
+        if isinstance(parsed, dict) and "Error" in parsed:
+            error = parsed["Error"].get("Code") or "Unknown"
+        self._finish(context, _response_size(http_response, model), error)
+
+    @_guarded
+    def after_call_error(self, exception, context, **kwargs):
+        """ Emits the record for a call which failed without a response """
+        self._finish(context, 0, type(exception).__name__)
+
+    def _finish(self, context, bytes_in: int, error: str):
+        state = context.pop(self.key, None)
+        if state is None:
+            return
+        record = CallRecord(
+            service=state["service"],
+            operation=state["operation"],
+            latency=perf_counter() - state["start"],
+            bytes_in=bytes_in,
+            bytes_out=state["bytes_out"],
+            retries=state["attempts"] - 1,
+            throttles=state["throttles"],
+            error=error,
+        )
+        for sink in self.sinks:
+            try:
+                sink(record)
+            except Exception as err:  # pylint: disable=broad-except
+                log.error(
+                    "Metrics sink failed for %s.%s: %s",
+                    record.service,
+                    record.operation,
+                    err,
+                )
+
+
+def instrument(client, sink: Callable[[CallRecord], None]):
+    """
+    Registers event handlers on the given boto3 client so that every API call it makes is
+    reported to `sink`. Each client is hooked once and fans records out to all of its sinks;
+    adding a sink that is already registered (by equality) is a no-op.
+    """
+    instrumenter = getattr(client, "_metrics_instrumenter", None)
+    if instrumenter is None:
+        instrumenter = _Instrumenter()
+        client._metrics_instrumenter = instrumenter
+        events = client.meta.events
+        # before-call stops at the first handler returning a response (e.g. stubs), so go first
+        events.register_first(
+            "before-call.*.*",
+            instrumenter.before_call,
+            unique_id="py_aws_util.metrics.before-call",
+        )
+        for event, handler in (
+            ("request-created", instrumenter.request_created),
+            ("needs-retry", instrumenter.needs_retry),
+            ("after-call", instrumenter.after_call),
+            ("after-call-error", instrumenter.after_call_error),
+        ):
+            events.register(
+                event + ".*.*", handler, unique_id="py_aws_util.metrics." + event
+            )
+    if sink not in instrumenter.sinks:
+        instrumenter.sinks.append(sink)
+    return client
+
+
+def _request_size(request) -> int:
+    """ Returns the size of the request body in bytes, without consuming streaming bodies """
+    length = request.headers.get("Content-Length")
+    if length is not None:
+        return int(length)
+    body = request.data
+    if not body:
+        return 0
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode("utf-8"))
+    if isinstance(body, dict):
+        return len(urlencode(body, doseq=True))
+    try:
+        position = body.tell()
+        body.seek(0, io.SEEK_END)
+        end = body.tell()
+        body.seek(position)
+        return end - position
+    except (AttributeError, OSError, TypeError, ValueError):
+        return 0
+
+
+def _response_size(http_response, model) -> int:
+    """
+    Returns the size of the response body in bytes, without reading streaming bodies. HEAD
+    responses carry the object's Content-Length but no body, so they count as zero, as do
+    responses without a body at all (e.g. stubbed ones).
+    """
+    if model.http.get("method") == "HEAD":
+        return 0
+    if getattr(http_response, "raw", None) is None:
+        return 0
+    if http_response.status_code in (204, 304):
+        return 0
+    if not model.has_streaming_output:
+        return len(getattr(http_response, "content", None) or b"")
+    headers = getattr(http_response, "headers", None) or {}
+    return int(headers.get("content-length") or 0)
+
+
+def _is_throttle(response) -> bool:
+    """ Returns true if the (http_response, parsed) pair is a throttling error """
+    http_response, parsed = response
+    if getattr(http_response, "status_code", None) == 429:
+        return True
+    code = (parsed or {}).get("Error", {}).get("Code")
+    return code in THROTTLE_CODES
@@ -0,0 +1,242 @@
+"""
+Test (non-network) instrumentation functionality
+"""
+import io
+import socket
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from types import SimpleNamespace
+import boto3
+from botocore.stub import Stubber
+from instrumentation import (
+    CallRecord,
+    MetricsRegistry,
+    StatsdSink,
+    _Instrumenter,
+    instrument,
+)
+
+MODEL = SimpleNamespace(
+    name="GetObject",
+    service_model=SimpleNamespace(service_name="s3"),
+    has_streaming_output=True,
+    http={"method": "GET"},
+)
+RECORD = CallRecord(
+    service="s3",
+    operation="GetObject",
+    latency=0.02,
+    bytes_in=512,
+    bytes_out=0,
+    retries=1,
+    throttles=1,
+)
+
+
+class _S3Handler(BaseHTTPRequestHandler):
+    """ Loopback S3 endpoint: throttles the first GET, and reports huge objects on HEAD """
+
+    gets = 0
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                self.rfile.read(size + 2)
+                if size == 0:
+                    # aws-chunked requests may carry trailing checksum headers
+                    while self.rfile.readline() not in (b"\r\n", b""):
+                        pass
+                    return
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _respond(self, status: int, body: bytes = b"", length: int = None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body) if length is None else length))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        _S3Handler.gets += 1
+        if _S3Handler.gets == 1:
+            self._respond(503, b"<Error><Code>SlowDown</Code></Error>")
+        else:
+            self._respond(200, b"hello world")
+
+    def do_HEAD(self):
+        self._respond(200, length=5000000000)
+
+    def do_PUT(self):
+        self._read_body()
+        self._respond(200)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestInstrumentation(unittest.TestCase):
+    """ Test (non-network) instrumentation functionality """
+
+    def test_registry(self):
+        """ Check aggregation of call records into the in-memory registry """
+        registry = MetricsRegistry()
+        registry(RECORD)
+        registry(RECORD._replace(latency=20.0, error="SlowDown"))
+        stats = registry.snapshot()["s3.GetObject"]
+        self.assertEqual(stats["calls"], 2)
+        self.assertEqual(stats["errors"], 1)
+        self.assertEqual(stats["bytes_in"], 1024)
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["throttles"], 2)
+        self.assertEqual(stats["latency_max"], 20.0)
+        self.assertEqual(stats["histogram"][2], 1)
+        self.assertEqual(stats["histogram"][-1], 1)
+        registry.reset()
+        self.assertEqual(registry.snapshot(), {})
+
+    def test_statsd_lines(self):
+        """ Check StatsD formatting of a call record """
+        lines = []
+        sink = StatsdSink(prefix="app", writer=lines.append)
+        sink(RECORD)
+        self.assertEqual(
+            lines[0].split("\n"),
+            [
+                "app.s3.GetObject.latency:20.000|ms",
+                "app.s3.GetObject.calls:1|c",
+                "app.s3.GetObject.bytes_in:512|c",
+                "app.s3.GetObject.bytes_out:0|c",
+                "app.s3.GetObject.retries:1|c",
+                "app.s3.GetObject.throttles:1|c",
+            ],
+        )
+
+    def test_statsd_without_daemon(self):
+        """ Check that StatsD datagrams to a closed port are dropped silently """
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed.bind(("127.0.0.1", 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        sink = StatsdSink("localhost", port)
+        self.addCleanup(sink.close)
+        instrumenter = _Instrumenter()
+        instrumenter.sinks.append(sink)
+        # assertNoLogs needs Python 3.10, so expect assertLogs to find nothing
+        with self.assertRaises(AssertionError):
+            with self.assertLogs(level="ERROR"):
+                for _ in range(5):
+                    context = {}
+                    instrumenter.before_call(model=MODEL, context=context)
+                    instrumenter.after_call_error(
+                        exception=ConnectionError(), context=context
+                    )
+
+    def test_handlers(self):
+        """ Check that the event handlers build one record across retried attempts """
+        records = []
+        instrumenter = _Instrumenter()
+        instrumenter.sinks.append(records.append)
+        context = {}
+        instrumenter.before_call(model=MODEL, context=context)
+        for attempt in (1, 2):
+            request = SimpleNamespace(
+                headers={}, data=io.BytesIO(b"payload"), context=context
+            )
+            instrumenter.request_created(request=request)
+            throttled = SimpleNamespace(status_code=503, headers={})
+            response = (throttled, {"Error": {"Code": "SlowDown"}})
+            if attempt == 2:
+                response = (SimpleNamespace(status_code=200, headers={}), {})
+            instrumenter.needs_retry(
+                attempts=attempt, response=response, request_dict={"context": context}
+            )
+        http_response = SimpleNamespace(
+            raw=object(), status_code=200, headers={"content-length": "42"}
+        )
+        instrumenter.after_call(
+            http_response=http_response, parsed={}, model=MODEL, context=context
+        )
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual((record.service, record.operation), ("s3", "GetObject"))
+        self.assertEqual(record.bytes_out, 14)
+        self.assertEqual(record.bytes_in, 42)
+        self.assertEqual(record.retries, 1)
+        self.assertEqual(record.throttles, 1)
+        self.assertIsNone(record.error)
+        self.assertEqual(context, {})
+
+    def test_failing_sink(self):
+        """ Check that a failing sink is logged and does not propagate into the AWS call """
+
+        def sink(_):
+            raise RuntimeError("sink is down")
+
+        instrumenter = _Instrumenter()
+        instrumenter.sinks.append(sink)
+        context = {}
+        instrumenter.before_call(model=MODEL, context=context)
+        with self.assertLogs(level="ERROR") as logs:
+            instrumenter.after_call_error(exception=ConnectionError(), context=context)
+        self.assertIn("sink is down", logs.output[0])
+        self.assertEqual(context, {})
+
+    def test_failing_hook(self):
+        """ Check that an error inside a hook is logged rather than raised """
+        instrumenter = _Instrumenter()
+        with self.assertLogs(level="ERROR") as logs:
+            instrumenter.before_call(model=None, context={})
+        self.assertIn("before_call", logs.output[0])
+
+    def test_stubbed_client(self):
+        """ Check that instrument() hooks a real client once, however often it is called """
+        records = []
+        client = boto3.client(
+            "s3",
+            region_name="us-east-1",
+            aws_access_key_id="testing",
+            aws_secret_access_key="testing",
+        )
+        instrument(client, records.append)
+        instrument(client, records.append)
+        with Stubber(client) as stubber:
+            stubber.add_response("head_object", {"ContentLength": 5000000000})
+            stubber.add_client_error("get_object", "NoSuchKey", http_status_code=404)
+            client.head_object(Bucket="some-bucket", Key="some_key")
+            with self.assertRaises(client.exceptions.NoSuchKey):
+                client.get_object(Bucket="some-bucket", Key="some_key")
+        self.assertEqual(
+            [(r.operation, r.bytes_in, r.error) for r in records],
+            [("HeadObject", 0, None), ("GetObject", 0, "NoSuchKey")],
+        )
+
+    def test_loopback_client(self):
+        """ Check retries, throttles and byte counts on a real client over loopback """
+        server = HTTPServer(("127.0.0.1", 0), _S3Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        registry = MetricsRegistry()
+        client = boto3.client(
+            "s3",
+            region_name="us-east-1",
+            endpoint_url="http://127.0.0.1:{}".format(server.server_port),
+            aws_access_key_id="testing",
+            aws_secret_access_key="testing",
+        )
+        instrument(client, registry)
+
+        body = client.get_object(Bucket="some-bucket", Key="some_key")["Body"].read()
+        client.head_object(Bucket="some-bucket", Key="some_key")
+        client.upload_fileobj(io.BytesIO(b"x" * 100), "some-bucket", "some_key")
+
+        self.assertEqual(body, b"hello world")
+        stats = registry.snapshot()
+        self.assertEqual(stats["s3.GetObject"]["retries"], 1)
+        self.assertEqual(stats["s3.GetObject"]["throttles"], 1)
+        self.assertEqual(stats["s3.GetObject"]["bytes_in"], 11)
+        self.assertEqual(stats["s3.HeadObject"]["bytes_in"], 0)
+        self.assertEqual(stats["s3.PutObject"]["errors"], 0)
+        self.assertGreaterEqual(stats["s3.PutObject"]["bytes_out"], 100)
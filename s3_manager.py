@@ -6,9 +6,10 @@ transformations and is more similar in design to the functionality found in back
 import re
 import io
 from logger import logging as log
-from typing import List, AnyStr
+from typing import List, AnyStr, Callable
 from botocore.exceptions import ClientError
 import boto3
+from instrumentation import CallRecord, instrument
 
 
 class Session:
@@ -16,8 +17,14 @@ class Session:
     High-level, path based wrapper around boto3 S3 operations
     """
 
-    def __init__(self):
+    def __init__(self, sink: Callable[[CallRecord], None] = None):
+        """
+        Constructor for a Session instance. If a metrics sink is provided, every S3 call made
+        by the session is reported to it (see instrumentation).
+        """
         self.client = boto3.client("s3")
+        if sink is not None:
+            instrument(self.client, sink)
         self.buffer = io.StringIO()
         self.error = None
 
@@ -2,12 +2,21 @@
 Transformation functions for use in conjunction with s3 manager operations.
 """
 import json
+from typing import Callable
 from pandas import DataFrame, read_csv, read_json
+from instrumentation import CallRecord, instrument
 from s3_manager import Session, parse_path
 
 s3mgr = Session()
 
 
+def set_metrics_sink(sink: Callable[[CallRecord], None]):
+    """
+    Reports every S3 call made by the transformation functions to the given metrics sink
+    """
+    instrument(s3mgr.client, sink)
+
+
 def read_csv_to_df(path: str) -> DataFrame:
     """
     Reads a csv-like file from the given S3 path and converts it into a Pandas dataframe
@@ -3,4 +3,8 @@ A module for data scientists to more easily manage S3 and EMR cluster resources
 """
 from setuptools import setup
 
-setup(name="py-aws-util", version="1.0.0", packages=["cluster_manager", "s3_manager"])
+setup(
+    name="py-aws-util",
+    version="1.0.0",
+    packages=["cluster_manager", "s3_manager", "instrumentation"],
+)